@@ -1,19 +1,158 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import json
+import time
+
 import requests
 
 from aggregation.country_data_aggregator import CountryDataAggregator
-from aggregation.validation import validate_aggregation_request
+from aggregation.validation import get_projected_fields, validate_aggregation_request
 
 
 # we could put this in a config
 DATA_API_URL = 'XXX'
+# list per region or sharded endpoints here, results are merged into one data set
+DATA_SOURCES = [DATA_API_URL]
+# number of pages fetched at the same time
+FETCH_WORKERS = 4
+# attempts per page before giving up on the download
+FETCH_ATTEMPTS = 3
+# seconds to wait before the first retry, doubled for each following retry
+FETCH_BACKOFF = 0.5
+# client errors that are usually temporary, retried like server errors
+RETRY_STATUS_CODES = [408, 429]
+FETCH_TIMEOUT = 15
+# upper bound of pages per download, guards against cursors that never end
+MAX_PAGES = 1000
+# default to caching data for a day
+DEFAULT_CACHE_TIME = 86400
+
+
+class FetchError(Exception):
+    """Raised when a page of country data could not be retrieved
+    """
+
+
+def get_max_age(headers):
+    """Return cache control max-age seconds from response headers
+
+    Keyword arguments:
+    headers -- response headers
+    """
+    seconds = DEFAULT_CACHE_TIME
+    cache_control = headers.get('Cache-Control')
+    if cache_control:
+        parts = cache_control.split(',')
+        for part in parts:
+            if part.strip().startswith('max-age='):
+                _, seconds = part.split('=', 1)
+    try:
+        return int(seconds)
+    except ValueError:
+        # malformed max-age, use the default
+        return DEFAULT_CACHE_TIME
+
+def get_retry_after(headers):
+    """Return numeric Retry-After seconds from response headers, None if missing
+    or not a number, capped at the request timeout
+
+    Keyword arguments:
+    headers -- response headers
+    """
+    try:
+        seconds = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+    if seconds < 0:
+        return None
+    return min(seconds, FETCH_TIMEOUT)
 
+def fetch_page(url, cursor=None):
+    """Fetch one page of country data, retrying the page on failure
 
-def process_aggregation_request(params):
+    Returns a tuple of (records, next cursor, max-age seconds). A page is either
+    a list of records, or a dictionary with the list of records under `data` and
+    the cursor of the following page under `next`. Server errors, timeouts,
+    408 and 429 responses and bodies that are not valid JSON are retried with
+    backoff, or after Retry-After when given. Other client errors and JSON
+    pages of the wrong shape are not retried.
+
+    Keyword arguments:
+    url -- data source url
+    cursor -- page cursor, None for the first page
+    """
+    params = {'fields': ','.join(get_projected_fields())}
+    if cursor:
+        params['cursor'] = cursor
+
+    retry_after = None
+    for attempt in range(FETCH_ATTEMPTS):
+        if attempt:
+            time.sleep(retry_after if retry_after is not None else FETCH_BACKOFF * 2 ** (attempt - 1))
+        retry_after = None
+        try:
+            response = requests.get(url, params=params, timeout=FETCH_TIMEOUT)
+            if response.status_code >= 500 or response.status_code in RETRY_STATUS_CODES:
+                retry_after = get_retry_after(response.headers)
+                continue
+            if response.status_code != 200:
+                # client errors will not go away on retry
+                break
+            page = json.loads(response.text)
+            seconds = get_max_age(response.headers)
+        except Exception:
+            # timeouts, connection errors and truncated bodies
+            continue
+
+        if isinstance(page, list):
+            return page, None, seconds
+        if isinstance(page, dict) and 'data' in page and isinstance(page.get('data') or [], list):
+            next_cursor = page.get('next')
+            if next_cursor is None or isinstance(next_cursor, (str, int)):
+                return page.get('data') or [], next_cursor, seconds
+        raise FetchError('Unexpected page format from %s' % url)
+
+    raise FetchError('Could not retrieve %s' % url)
+
+def fetch_country_data():
+    """Fetch and merge all pages of all data sources
+
+    Pages are fetched concurrently, a page's follow up page is queued as soon
+    as its cursor is known. Returns a tuple of (records, cache seconds), the
+    shortest max-age of all pages is used for the whole data set.
+    """
+    country_data = []
+    cache_time = None
+    fetched_pages = {(url, None) for url in DATA_SOURCES}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pending = {executor.submit(fetch_page, url): url for url in DATA_SOURCES}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    records, cursor, seconds = future.result()
+                    if cursor and (url, cursor) in fetched_pages:
+                        raise FetchError('Repeated page cursor %s from %s' % (cursor, url))
+                    if cursor and len(fetched_pages) >= MAX_PAGES:
+                        raise FetchError('More than %s pages from %s' % (MAX_PAGES, url))
+                except FetchError:
+                    for other in pending:
+                        other.cancel()
+                    raise
+                country_data.extend(records)
+                cache_time = seconds if cache_time is None else min(cache_time, seconds)
+                if cursor:
+                    fetched_pages.add((url, cursor))
+                    pending[executor.submit(fetch_page, url, cursor)] = url
+    return country_data, cache_time
+
+
+def process_aggregation_request(params, as_of=None):
     """Retrieve aggregated stats by aggregation type, metric, and region
 
     Keyword arguments:
     params -- dictionary of aggregation parameters
+    as_of -- datetime to query a retained data snapshot at, None for current data
     """
 
     # validate request parameters
@@ -24,13 +163,19 @@ def process_aggregation_request(params):
 
     # initialize aggregation object
     country_data = CountryDataAggregator()
+    snapshot_hash = None
+    if as_of:
+        # historical queries only use retained snapshots, never fetch
+        snapshot_hash = country_data.get_snapshot_hash_as_of(as_of)
+        if not snapshot_hash:
+            return None, 'No country data retained as of %s.' % as_of.strftime('%Y-%m-%d %H:%M:%S')
     # fetch data
-    if country_data.is_expired():
+    elif country_data.is_expired():
         try:
             # for showcasing code, we're not going to use the api url
             import sys
             if 'pytest' in sys.modules:
-                response = requests.get(DATA_API_URL, timeout=15)
+                json_data, seconds = fetch_country_data()
             else:
                 import os
                 from unittest.mock import patch
@@ -40,28 +185,19 @@ def process_aggregation_request(params):
                         mock_get.return_value.status_code = 200
                         mock_get.return_value.text = f.read()
                         mock_get.return_value.headers = {}
-                    response = requests.get(DATA_API_URL, timeout=15)
-            if response.status_code == 200:
-                json_data = json.loads(response.text)
-                # let's cache the data, use cache control max-age as indicator
-                # default to caching data for a day
-                seconds = 86400
-                cache_control = response.headers.get('Cache-Control')
-                if cache_control:
-                    parts = cache_control.split(',')
-                    for part in parts:
-                        if part.strip().startswith('max-age='):
-                            _, seconds = part.split('=')
-                country_data.store_data(json_data, int(seconds))
-            else:
-                # we can return a message if necessary
-                return None, 'Could not retrieve country data, please try again later.'
+                    json_data, seconds = fetch_country_data()
+            # let's cache the data, use cache control max-age as indicator
+            country_data.store_data(json_data, seconds)
         except Exception as e:
             # timeouts and other errors
             # we can break this up if necessary
             return None, 'Could not retrieve country data, please try again later.'
 
     # process aggregation
-    aggregation_results = country_data.get_aggregation(params)
+    aggregation_results = country_data.get_aggregation(params, snapshot_hash)
+    if aggregation_results is None:
+        if as_of:
+            return None, 'No country data retained as of %s.' % as_of.strftime('%Y-%m-%d %H:%M:%S')
+        return None, 'Could not retrieve country data, please try again later.'
 
     return aggregation_results, None
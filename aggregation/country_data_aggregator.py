@@ -1,9 +1,18 @@
 import datetime
 from functools import partial
+import hashlib
 import json
 import os
 import statistics
 
+from aggregation.validation import get_projected_fields
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# number of distinct data snapshots kept for as of queries
+SNAPSHOT_LIMIT = 5
+# number of snapshot index entries kept, data flipping between versions adds one per flip
+SNAPSHOT_INDEX_LIMIT = SNAPSHOT_LIMIT * 4
 
 # Map aggregation types to functions
 AGGREGATION_FUNCTIONS = {
@@ -57,6 +66,47 @@ def append_one(target, value):
     """
     target.append(1)
 
+def get_canonical_data(data):
+    """Return data projected to aggregated fields, in a stable record order
+
+    Keyword arguments:
+    data -- list of country records
+    """
+    fields = get_projected_fields()
+    projected_data = []
+    for record in data:
+        projected_data.append({field: record[field] for field in fields if field in record})
+    return sorted(projected_data, key=lambda record: json.dumps(record, sort_keys=True))
+
+def get_snapshot_hash(data):
+    """Return content hash of canonical country data
+
+    Keyword arguments:
+    data -- canonical list of country records
+    """
+    canonical_json = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical_json.encode('utf-8')).hexdigest()
+
+def write_file(file_name, content):
+    """Write file through a temporary file, so a failed write never leaves a
+    partial file behind
+
+    Keyword arguments:
+    file_name -- target file
+    content -- file content
+    """
+    temp_file = '%s.%s.tmp' % (file_name, os.getpid())
+    try:
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        os.replace(temp_file, file_name)
+    except Exception:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+        raise
+
 # Map custom accumulation and aggregation functions
 CUSTOM_PROCESSORS = {
     'countries': {
@@ -76,17 +126,32 @@ class CountryDataAggregator:
     def __init__(self):
         # put in config
         self.cache_file = 'country_data_cache.json'
+        self.snapshot_file = 'country_data_snapshot_%s.json'
 
         cached_data = {}
         if os.path.isfile(self.cache_file):
-            with open(self.cache_file) as f:
-                cached_data = json.loads(f.read())
-
-        self.country_data = cached_data.get('country_data')
+            try:
+                with open(self.cache_file) as f:
+                    cached_data = json.loads(f.read())
+            except (OSError, ValueError):
+                # e.g. truncated by an interrupted write, start over
+                pass
+        if not isinstance(cached_data, dict):
+            cached_data = {}
+
+        self.snapshot_hash = cached_data.get('snapshot_hash')
+        # fetches that changed the data, oldest first
+        self.snapshots = cached_data.get('snapshots', [])
+        self.country_data = self.read_snapshot(self.snapshot_hash) if self.snapshot_hash else None
         country_data_expiry = cached_data.get('country_data_expiry')
-        self.country_data_expiry = datetime.datetime.strptime(country_data_expiry, '%Y-%m-%d %H:%M:%S') if country_data_expiry else None
-        # let's cache aggregation request results
-        self.aggregation_request_results = cached_data.get('aggregation_request_results')
+        self.country_data_expiry = datetime.datetime.strptime(country_data_expiry, DATE_FORMAT) if country_data_expiry else None
+        # let's cache aggregation request results, keyed by snapshot hash then request key
+        snapshot_hashes = {snapshot.get('hash') for snapshot in self.snapshots}
+        self.aggregation_request_results = {
+            snapshot_hash: snapshot_results
+            for snapshot_hash, snapshot_results in cached_data.get('aggregation_request_results', {}).items()
+            if snapshot_hash in snapshot_hashes
+        }
 
     def get_request_key(self, params):
         """Generate request cache key
@@ -96,16 +161,17 @@ class CountryDataAggregator:
         """
         return '%s:%s:%s' % (params.get('aggregation'), params.get('field'), params.get('by'))
 
-    def accumulate_data_sets(self, field, by, accumulator):
+    def accumulate_data_sets(self, field, by, accumulator, country_data):
         """Collect and group target values in data set
 
         Keyword arguments:
         field -- value index
         by -- group by index
         accumulator -- custom accumulation function
+        country_data -- list of country records to accumulate
         """
         accumulation_results = {}
-        for data_set in self.country_data:
+        for data_set in country_data:
             group = data_set.get(by)
             if not group:
                 group = 'null'
@@ -154,50 +220,127 @@ class CountryDataAggregator:
         return False
 
     def store_data(self, data, cache_time):
-        """Store data, reset request cache, set expiry
+        """Store data snapshot, set expiry
+
+        Identical data keeps its snapshot and computed results, only the
+        expiry is extended.
 
         Keyword arguments:
         data -- country data
         cache_time -- seconds to cache expire
         """
+        data = get_canonical_data(data)
+        snapshot_hash = get_snapshot_hash(data)
+        now = datetime.datetime.now()
+
+        # rewrite the current snapshot too if its file could not be read
+        if snapshot_hash != self.snapshot_hash or self.country_data is None:
+            self.write_snapshot(snapshot_hash, data)
+        if snapshot_hash != self.snapshot_hash:
+            self.snapshots.append({'hash': snapshot_hash, 'fetched': now.strftime(DATE_FORMAT)})
+            self.prune_snapshots()
+
         self.country_data = data
-        self.country_data_expiry = datetime.datetime.now() + datetime.timedelta(seconds=cache_time)
-        self.aggregation_request_results = {}
+        self.snapshot_hash = snapshot_hash
+        self.country_data_expiry = now + datetime.timedelta(seconds=cache_time)
         self.write_cache()
 
-    def get_aggregation(self, params):
-        """Process aggregation request
+    def prune_snapshots(self):
+        """Drop oldest fetches until at most the retention limit of distinct
+        snapshots and index entries remain, with the files and results of
+        dropped snapshots
+        """
+        while (len(self.snapshots) > SNAPSHOT_INDEX_LIMIT or
+               len({snapshot.get('hash') for snapshot in self.snapshots}) > SNAPSHOT_LIMIT):
+            snapshot_hash = self.snapshots.pop(0).get('hash')
+            # the same data may have been fetched again later
+            if any(snapshot.get('hash') == snapshot_hash for snapshot in self.snapshots):
+                continue
+            self.aggregation_request_results.pop(snapshot_hash, None)
+            try:
+                os.unlink(self.snapshot_file % snapshot_hash)
+            except OSError:
+                pass
+
+    def get_snapshot_hash_as_of(self, as_of):
+        """Return hash of the snapshot current at a point in time, None if not retained
+
+        Keyword arguments:
+        as_of -- datetime to look up
+        """
+        for snapshot in reversed(self.snapshots):
+            if datetime.datetime.strptime(snapshot.get('fetched'), DATE_FORMAT) <= as_of:
+                return snapshot.get('hash')
+        return None
+
+    def get_aggregation(self, params, snapshot_hash=None):
+        """Process aggregation request, None if the snapshot data is not available
 
         Keyword arguments:
         params -- dictionary of aggregation parameters
+        snapshot_hash -- snapshot to aggregate, defaults to current data
         """
+        if snapshot_hash is None:
+            snapshot_hash = self.snapshot_hash
 
         # check cache
         key = self.get_request_key(params)
-        if key in self.aggregation_request_results:
-            return self.aggregation_request_results.get(key)
+        snapshot_results = self.aggregation_request_results.get(snapshot_hash, {})
+        if key in snapshot_results:
+            return snapshot_results.get(key)
 
         aggregation_method = params.get('aggregation')
         field = params.get('field')
         by = params.get('by')
 
+        if snapshot_hash == self.snapshot_hash:
+            country_data = self.country_data
+        else:
+            country_data = self.read_snapshot(snapshot_hash)
+        if country_data is None:
+            return None
+
         custom_processor = CUSTOM_PROCESSORS.get(field, {})
-        accumulation_results = self.accumulate_data_sets(field, by, custom_processor.get('accumulator'))
+        accumulation_results = self.accumulate_data_sets(field, by, custom_processor.get('accumulator'), country_data)
         aggregation_results = self.aggregate_data_sets(accumulation_results, aggregation_method, custom_processor.get('aggrigator'))
 
-        self.aggregation_request_results[key] = aggregation_results
+        self.aggregation_request_results.setdefault(snapshot_hash, {})[key] = aggregation_results
         self.write_cache()
 
         return aggregation_results
 
+    def read_snapshot(self, snapshot_hash):
+        """Read snapshot country data, None if the snapshot file is missing or unreadable
+
+        Keyword arguments:
+        snapshot_hash -- snapshot content hash
+        """
+        snapshot_file = self.snapshot_file % snapshot_hash
+        if not os.path.isfile(snapshot_file):
+            return None
+        try:
+            with open(snapshot_file) as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            # e.g. truncated by an interrupted write, refetch
+            return None
+
+    def write_snapshot(self, snapshot_hash, data):
+        """Write snapshot country data
+
+        Keyword arguments:
+        snapshot_hash -- snapshot content hash
+        data -- canonical country data
+        """
+        write_file(self.snapshot_file % snapshot_hash, json.dumps(data))
+
     def write_cache(self):
-        """Write country data, expiry, and computed results to cache
+        """Write snapshot index, expiry, and computed results to cache
         """
         cached_data = {
-            'country_data': self.country_data,
-            'country_data_expiry': self.country_data_expiry.strftime('%Y-%m-%d %H:%M:%S'),
+            'snapshot_hash': self.snapshot_hash,
+            'snapshots': self.snapshots,
+            'country_data_expiry': self.country_data_expiry.strftime(DATE_FORMAT),
             'aggregation_request_results': self.aggregation_request_results,
         }
-        with open(self.cache_file, 'w') as f:
-            f.write(json.dumps(cached_data))
-            f.truncate()
+        write_file(self.cache_file, json.dumps(cached_data))
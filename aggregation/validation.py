@@ -45,6 +45,16 @@ FIELD_OPTIONS = {
 }
 REGION_OPTIONS = ['region', 'subregion']
 
+def get_projected_fields():
+    """Return the data fields aggregation requests can use
+    """
+    fields = set(REGION_OPTIONS)
+    for field_options in FIELD_OPTIONS.values():
+        fields.update(field_options)
+    # countries is a count of records, not a data field
+    fields.discard('countries')
+    return sorted(fields)
+
 def validate_aggregation_request(data):
     """Validate aggregation request input
 
@@ -1,9 +1,12 @@
+import glob
 import os
 
 def pytest_runtest_setup(item):
     # put in config
     cache_file = 'country_data_cache.json'
-    try:
-        os.unlink(cache_file)
-    except Exception:
-        pass
\ No newline at end of file
+    snapshot_files = glob.glob('country_data_snapshot_*.json')
+    for file_name in [cache_file] + snapshot_files:
+        try:
+            os.unlink(file_name)
+        except Exception:
+            pass
\ No newline at end of file
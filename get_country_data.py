@@ -1,12 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
+import datetime
 import json
 import sys
 
 from aggregation.aggregation_processor import process_aggregation_request
 
 
+def parse_as_of(value):
+    """Parse as of argument, a date alone means the end of that day
+
+    Keyword arguments:
+    value -- 'YYYY-MM-DD HH:MM:SS' or 'YYYY-MM-DD'
+    """
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d') + datetime.timedelta(days=1, seconds=-1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '%s', expected YYYY-MM-DD [HH:MM:SS]" % value)
+
+
 def get_country_data():
     """Retrieve aggregated stats by aggregation type, metric, and region
     """
@@ -50,6 +67,11 @@ def get_country_data():
         ],
         help='Field to group aggregates by',
     )
+    parser.add_argument(
+        '--as-of',
+        type=parse_as_of,
+        help='Query the data snapshot retained at this time, YYYY-MM-DD [HH:MM:SS]',
+    )
 
     args = parser.parse_args()
     params = {
@@ -57,7 +79,7 @@ def get_country_data():
         'field': args.field,
         'by': args.by,
     }
-    return process_aggregation_request(params)
+    return process_aggregation_request(params, args.as_of)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import datetime
 from functools import partial
 import json
+import os
 from unittest.mock import mock_open, patch
 
 from freezegun import freeze_time
@@ -11,6 +12,8 @@ from aggregation.country_data_aggregator import (
     append_list,
     append_one,
     CountryDataAggregator,
+    get_canonical_data,
+    get_snapshot_hash,
 )
 
 
@@ -47,18 +50,22 @@ def test_append_one(target, value, expected):
     assert target == expected
 
 
+COUNTRY_DATA = [
+    {'area': 1, 'borders': ['a', 'b', 'c'], 'currencies': ['d', 'e'], 'gini': 11.11, 'latlng': [10.1, 12.2], 'region': 'a', 'subregion': 'aa'},
+    {'area': 2, 'borders': ['d', 'e'], 'currencies': ['f'], 'gini': 12.12, 'latlng': [20.2, 22.3], 'region': 'a', 'subregion': 'aa'},
+    {'area': 3, 'borders': ['f']},
+    {'area': 4, 'borders': ['x'], 'currencies': ['x', 'y'], 'gini': 100.1, 'latlng': [50.1, 62.2], 'region': 'b', 'subregion': 'ba'},
+    {'area': 5, 'borders': ['y', 'z'], 'currencies': ['z', 'a'], 'gini': 100.2, 'latlng': [70.2, 82.3], 'region': 'b', 'subregion': 'bb'},
+]
+
 @pytest.fixture(scope='module')
 def aggregator():
     aggregator = CountryDataAggregator()
     aggregator.country_data_expiry = datetime.datetime.now()
-    aggregator.country_data = [
-        {'area': 1, 'borders': ['a', 'b', 'c'], 'currencies': ['d', 'e'], 'gini': 11.11, 'latlng': [10.1, 12.2], 'region': 'a', 'subregion': 'aa'},
-        {'area': 2, 'borders': ['d', 'e'], 'currencies': ['f'], 'gini': 12.12, 'latlng': [20.2, 22.3], 'region': 'a', 'subregion': 'aa'},
-        {'area': 3, 'borders': ['f']},
-        {'area': 4, 'borders': ['x'], 'currencies': ['x', 'y'], 'gini': 100.1, 'latlng': [50.1, 62.2], 'region': 'b', 'subregion': 'ba'},
-        {'area': 5, 'borders': ['y', 'z'], 'currencies': ['z', 'a'], 'gini': 100.2, 'latlng': [70.2, 82.3], 'region': 'b', 'subregion': 'bb'},
-    ]
-    aggregator.aggregation_request_results = {'a:b:c': 'test'}
+    aggregator.country_data = COUNTRY_DATA
+    aggregator.snapshot_hash = 'abc'
+    aggregator.snapshots = [{'hash': 'abc', 'fetched': '2019-09-19 00:00:00'}]
+    aggregator.aggregation_request_results = {'abc': {'a:b:c': 'test'}}
     return aggregator
 
 @pytest.fixture(scope='module')
@@ -66,7 +73,8 @@ def mock_cache_file():
     with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
         mock_isfile.return_value = True
         with patch('builtins.open', mock_open(read_data='{}')) as mock_cache_file:
-            yield mock_isfile, mock_cache_file
+            with patch('aggregation.country_data_aggregator.os.replace') as mock_replace:
+                yield mock_isfile, mock_cache_file, mock_replace
 
 @pytest.mark.parametrize(
     'aggregation, field, by, expected',
@@ -84,6 +92,47 @@ def test_aggregator_get_aggregation(mock_cache_file, aggregator, aggregation, fi
     results = aggregator.get_aggregation(params)
     assert results == expected
 
+def test_aggregator_get_aggregation_snapshot(mock_cache_file, aggregator):
+    params = {
+        'aggregation': 'sum',
+        'field': 'area',
+        'by': 'region',
+    }
+    with patch.object(aggregator, 'read_snapshot', return_value=[{'area': 7, 'region': 'a'}]) as mock_read_snapshot:
+        results = aggregator.get_aggregation(params, 'old')
+
+    mock_read_snapshot.assert_called_once_with('old')
+    assert results == {'a': 7}
+    assert aggregator.aggregation_request_results['old'] == {'sum:area:region': {'a': 7}}
+
+def test_aggregator_get_aggregation_snapshot_missing(mock_cache_file, aggregator):
+    params = {
+        'aggregation': 'sum',
+        'field': 'area',
+        'by': 'region',
+    }
+    with patch.object(aggregator, 'read_snapshot', return_value=None):
+        results = aggregator.get_aggregation(params, 'missing')
+
+    assert results is None
+    assert 'missing' not in aggregator.aggregation_request_results
+
+def test_get_canonical_data():
+    data = [
+        {'name': 'b', 'area': 2, 'region': 'x'},
+        {'name': 'a', 'area': 1, 'latlng': [1.0, 2.0]},
+    ]
+    assert get_canonical_data(data) == [{'area': 1, 'latlng': [1.0, 2.0]}, {'area': 2, 'region': 'x'}]
+
+def test_get_snapshot_hash():
+    data = [{'area': 1, 'region': 'x'}, {'area': 2}]
+    same_data = [{'area': 2, 'name': 'b'}, {'region': 'x', 'area': 1}]
+    other_data = [{'area': 1, 'region': 'x'}, {'area': 3}]
+
+    snapshot_hash = get_snapshot_hash(get_canonical_data(data))
+    assert snapshot_hash == get_snapshot_hash(get_canonical_data(same_data))
+    assert snapshot_hash != get_snapshot_hash(get_canonical_data(other_data))
+
 def test_aggregator_get_request_key(aggregator):
     params = {
         'aggregation': 'a',
@@ -102,7 +151,7 @@ def test_aggregator_get_request_key(aggregator):
     ],
 )
 def test_aggregator_accumulate_data_sets(aggregator, field, by, accumulator, expected):
-    results = aggregator.accumulate_data_sets(field, by, accumulator)
+    results = aggregator.accumulate_data_sets(field, by, accumulator, COUNTRY_DATA)
     assert results == expected
 
 @pytest.mark.parametrize(
@@ -132,24 +181,185 @@ def test_aggregator_is_expired(aggregator, country_data, cache_expiry, expected)
 
 @freeze_time('2019-09-20 00:00:00')
 def test_aggregator_store_data(mock_cache_file, aggregator):
-    country_data = [{'a': 'b'}, {'c': 'd'}]
+    country_data = [{'area': 2}, {'area': 1, 'name': 'a'}]
+    canonical_data = [{'area': 1}, {'area': 2}]
+    snapshot_hash = get_snapshot_hash(canonical_data)
     aggregator.store_data(country_data, 60)
-    assert aggregator.country_data == country_data
+    assert aggregator.country_data == canonical_data
+    assert aggregator.snapshot_hash == snapshot_hash
+    assert aggregator.snapshots[-1] == {'hash': snapshot_hash, 'fetched': '2019-09-20 00:00:00'}
     assert aggregator.country_data_expiry == datetime.datetime.now() + datetime.timedelta(seconds=60)
-    assert aggregator.aggregation_request_results == {}
+    assert aggregator.aggregation_request_results['abc']['a:b:c'] == 'test'
+
+def test_aggregator_store_data_identical(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    with freeze_time('2019-09-20 00:00:00'):
+        aggregator.store_data([{'area': 1}], 60)
+    snapshot_hash = aggregator.snapshot_hash
+    aggregator.aggregation_request_results[snapshot_hash] = {'a:b:c': 'test'}
+
+    with freeze_time('2019-09-21 00:00:00'):
+        aggregator.store_data([{'area': 1, 'name': 'a'}], 60)
+
+    assert aggregator.snapshots == [{'hash': snapshot_hash, 'fetched': '2019-09-20 00:00:00'}]
+    assert aggregator.aggregation_request_results == {snapshot_hash: {'a:b:c': 'test'}}
+    assert aggregator.country_data_expiry == datetime.datetime(2019, 9, 21, 0, 1)
+
+def test_aggregator_store_data_unreadable_snapshot(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    aggregator.store_data([{'area': 1}], 60)
+    # snapshot file could not be read on load
+    aggregator.country_data = None
+    with patch.object(aggregator, 'write_snapshot') as mock_write_snapshot:
+        aggregator.store_data([{'area': 1}], 60)
+
+    mock_write_snapshot.assert_called_once_with(aggregator.snapshot_hash, [{'area': 1}])
+    assert len(aggregator.snapshots) == 1
+
+@pytest.mark.parametrize(
+    'read_data',
+    [
+        ('{"snapshot_hash": "abc", "snaps'), # truncated cache file
+        ('[]'), # not a cache
+    ],
+)
+def test_aggregator_load_unreadable_cache(read_data):
+    with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
+        mock_isfile.return_value = True
+        with patch('builtins.open', mock_open(read_data=read_data)):
+            aggregator = CountryDataAggregator()
+
+    assert aggregator.snapshot_hash is None
+    assert aggregator.snapshots == []
+    assert aggregator.is_expired()
+
+def test_aggregator_load_drops_unknown_results():
+    read_data = {
+        'snapshot_hash': 'abc',
+        'snapshots': [{'hash': 'abc', 'fetched': '2019-09-20 00:00:00'}],
+        'country_data_expiry': '2019-09-20 01:00:00',
+        'aggregation_request_results': {'abc': {'a:b:c': 'test'}, 'sum:area:region': {'a': 1}},
+    }
+    with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
+        mock_isfile.return_value = True
+        with patch('builtins.open', mock_open(read_data=json.dumps(read_data))):
+            aggregator = CountryDataAggregator()
+
+    assert aggregator.aggregation_request_results == {'abc': {'a:b:c': 'test'}}
+
+def test_aggregator_prune_snapshots(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    aggregator.snapshots = [
+        {'hash': 'a', 'fetched': '2019-09-15 00:00:00'},
+        {'hash': 'b', 'fetched': '2019-09-16 00:00:00'},
+        {'hash': 'c', 'fetched': '2019-09-17 00:00:00'},
+        {'hash': 'a', 'fetched': '2019-09-18 00:00:00'},
+        {'hash': 'd', 'fetched': '2019-09-19 00:00:00'},
+        {'hash': 'e', 'fetched': '2019-09-20 00:00:00'},
+        {'hash': 'f', 'fetched': '2019-09-21 00:00:00'},
+    ]
+    aggregator.aggregation_request_results = {'a': {}, 'b': {}, 'c': {}, 'd': {}, 'e': {}, 'f': {}}
+    with patch('aggregation.country_data_aggregator.os.unlink') as mock_unlink:
+        aggregator.prune_snapshots()
+
+    # a was fetched again, only b is dropped
+    mock_unlink.assert_called_once_with('country_data_snapshot_b.json')
+    assert [snapshot['hash'] for snapshot in aggregator.snapshots] == ['c', 'a', 'd', 'e', 'f']
+    assert sorted(aggregator.aggregation_request_results) == ['a', 'c', 'd', 'e', 'f']
+
+def test_aggregator_prune_snapshots_index_limit(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    # data flipping between two versions
+    aggregator.snapshots = [
+        {'hash': 'ab'[day % 2], 'fetched': '2019-09-%02d 00:00:00' % day}
+        for day in range(1, 11)
+    ]
+    aggregator.aggregation_request_results = {'a': {}, 'b': {}}
+    with patch('aggregation.country_data_aggregator.SNAPSHOT_LIMIT', 2):
+        with patch('aggregation.country_data_aggregator.SNAPSHOT_INDEX_LIMIT', 4):
+            with patch('aggregation.country_data_aggregator.os.unlink') as mock_unlink:
+                aggregator.prune_snapshots()
+
+    # both snapshots are still in the index, only old entries are dropped
+    mock_unlink.assert_not_called()
+    assert [snapshot['fetched'][:10] for snapshot in aggregator.snapshots] == ['2019-09-07', '2019-09-08', '2019-09-09', '2019-09-10']
+    assert sorted(aggregator.aggregation_request_results) == ['a', 'b']
+
+@pytest.mark.parametrize(
+    'as_of, expected',
+    [
+        (datetime.datetime(2019, 9, 14), None), # before first snapshot
+        (datetime.datetime(2019, 9, 15), 'a'), # at first snapshot
+        (datetime.datetime(2019, 9, 16, 12), 'b'), # between snapshots
+        (datetime.datetime(2019, 9, 30), 'a'), # after refetch of earlier data
+    ],
+)
+def test_aggregator_get_snapshot_hash_as_of(mock_cache_file, as_of, expected):
+    aggregator = CountryDataAggregator()
+    aggregator.snapshots = [
+        {'hash': 'a', 'fetched': '2019-09-15 00:00:00'},
+        {'hash': 'b', 'fetched': '2019-09-16 00:00:00'},
+        {'hash': 'a', 'fetched': '2019-09-17 00:00:00'},
+    ]
+    assert aggregator.get_snapshot_hash_as_of(as_of) == expected
+
+def test_aggregator_read_snapshot():
+    with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
+        mock_isfile.return_value = False
+        aggregator = CountryDataAggregator()
+        assert aggregator.read_snapshot('abc') is None
+
+        mock_isfile.return_value = True
+        with patch('builtins.open', mock_open(read_data='[{"area": 1}]')) as mock_file:
+            assert aggregator.read_snapshot('abc') == [{'area': 1}]
+        mock_file.assert_called_with('country_data_snapshot_abc.json')
+
+        # truncated file
+        with patch('builtins.open', mock_open(read_data='[{"area"')):
+            assert aggregator.read_snapshot('abc') is None
+
+def test_aggregator_write_snapshot(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    temp_file = 'country_data_snapshot_abc.json.%s.tmp' % os.getpid()
+    with patch('builtins.open', mock_open()) as mock_file:
+        with patch('aggregation.country_data_aggregator.os.replace') as mock_replace:
+            aggregator.write_snapshot('abc', [{'area': 1}])
+
+    mock_file.assert_called_once_with(temp_file, 'w')
+    mock_file().write.assert_called_once_with(json.dumps([{'area': 1}]))
+    mock_replace.assert_called_once_with(temp_file, 'country_data_snapshot_abc.json')
+
+def test_aggregator_write_snapshot_failure(mock_cache_file):
+    aggregator = CountryDataAggregator()
+    temp_file = 'country_data_snapshot_abc.json.%s.tmp' % os.getpid()
+    with patch('builtins.open', mock_open()) as mock_file:
+        mock_file().write.side_effect = OSError('disk full')
+        with patch('aggregation.country_data_aggregator.os.replace') as mock_replace:
+            with patch('aggregation.country_data_aggregator.os.unlink') as mock_unlink:
+                with pytest.raises(OSError):
+                    aggregator.write_snapshot('abc', [{'area': 1}])
+
+    mock_replace.assert_not_called()
+    mock_unlink.assert_called_once_with(temp_file)
 
 def test_aggregator_write_cache(mock_cache_file, aggregator):
     expiry = datetime.datetime.now()
-    aggregator.country_data = {'a': 'b'}
+    aggregator.snapshot_hash = 'abc'
+    aggregator.snapshots = [{'hash': 'abc', 'fetched': '2019-09-20 00:00:00'}]
     aggregator.country_data_expiry = expiry
-    aggregator.aggregation_request_results = {'c': 'd'}
+    aggregator.aggregation_request_results = {'abc': {'c': 'd'}}
     aggregator.write_cache()
 
     cache_data = {
-        'country_data': aggregator.country_data,
+        'snapshot_hash': aggregator.snapshot_hash,
+        'snapshots': aggregator.snapshots,
         'country_data_expiry': aggregator.country_data_expiry.strftime('%Y-%m-%d %H:%M:%S'),
         'aggregation_request_results': aggregator.aggregation_request_results,
     }
+    temp_file = 'country_data_cache.json.%s.tmp' % os.getpid()
     mock_file = mock_cache_file[1]
+    mock_file.assert_called_with(temp_file, 'w')
     handle = mock_file()
     handle.write.assert_called_with(json.dumps(cache_data))
+    mock_replace = mock_cache_file[2]
+    mock_replace.assert_called_with(temp_file, 'country_data_cache.json')
@@ -1,13 +1,21 @@
 import argparse
 import datetime
 import json
-from unittest.mock import mock_open, patch
+from unittest.mock import Mock, mock_open, patch
 
 from freezegun import freeze_time
 import pytest
 
-from aggregation.aggregation_processor import process_aggregation_request
-from aggregation.country_data_aggregator import CountryDataAggregator
+from aggregation.aggregation_processor import (
+    fetch_country_data,
+    fetch_page,
+    FetchError,
+    get_max_age,
+    process_aggregation_request,
+)
+from aggregation.country_data_aggregator import CountryDataAggregator, get_snapshot_hash
+from aggregation.validation import get_projected_fields
+from get_country_data import parse_as_of
 
 
 @pytest.fixture(scope='module')
@@ -19,15 +27,22 @@ def mock_args():
     }
     yield request_args
 
+@pytest.fixture(autouse=True)
+def mock_sleep():
+    # skip retry backoff
+    with patch('aggregation.aggregation_processor.time.sleep') as mock_sleep:
+        yield mock_sleep
+
 @pytest.fixture(scope='module')
 def mock_cache_file():
     with patch('builtins.open', mock_open()) as mock_cache_file:
-        yield mock_cache_file
+        with patch('aggregation.country_data_aggregator.os.replace'):
+            yield mock_cache_file
 
 def test_process_aggregation_request_valid_request(mock_args, mock_cache_file):
     with patch('aggregation.aggregation_processor.requests.get') as mock_get:
         mock_get.return_value.status_code = 200
-        mock_get.return_value.text = '{}'
+        mock_get.return_value.text = '[]'
         mock_get.return_value.headers = {}
 
         response, error = process_aggregation_request(mock_args)
@@ -39,7 +54,7 @@ def test_process_aggregation_request_valid_request(mock_args, mock_cache_file):
 def test_process_aggregation_request_valid_request_no_max_age(mock_args, mock_cache_file):
     with patch('aggregation.aggregation_processor.requests.get') as mock_get:
         mock_get.return_value.status_code = 200
-        mock_get.return_value.text = '{}'
+        mock_get.return_value.text = '[]'
         mock_get.return_value.headers = {'Cache-Control': 'a=b'}
 
         response, error = process_aggregation_request(mock_args)
@@ -48,10 +63,12 @@ def test_process_aggregation_request_valid_request_no_max_age(mock_args, mock_ca
     assert response == {}
 
     expiry = datetime.datetime.now() + datetime.timedelta(seconds=86400)
+    snapshot_hash = get_snapshot_hash([])
     cache_data = {
-        'country_data': {},
+        'snapshot_hash': snapshot_hash,
+        'snapshots': [{'hash': snapshot_hash, 'fetched': '2019-09-20 00:00:00'}],
         'country_data_expiry': expiry.strftime('%Y-%m-%d %H:%M:%S'),
-        'aggregation_request_results': {"sum:area:region": {}},
+        'aggregation_request_results': {snapshot_hash: {"sum:area:region": {}}},
     }
     handle = mock_cache_file()
     handle.write.assert_called_with(json.dumps(cache_data))
@@ -60,7 +77,7 @@ def test_process_aggregation_request_valid_request_no_max_age(mock_args, mock_ca
 def test_process_aggregation_request_valid_request_with_max_age(mock_args, mock_cache_file):
     with patch('aggregation.aggregation_processor.requests.get') as mock_get:
         mock_get.return_value.status_code = 200
-        mock_get.return_value.text = '{}'
+        mock_get.return_value.text = '[]'
         mock_get.return_value.headers = {'Cache-Control': 'max-age=60'}
 
         response, error = process_aggregation_request(mock_args)
@@ -69,10 +86,12 @@ def test_process_aggregation_request_valid_request_with_max_age(mock_args, mock_
     assert response == {}
 
     expiry = datetime.datetime.now() + datetime.timedelta(seconds=60)
+    snapshot_hash = get_snapshot_hash([])
     cache_data = {
-        'country_data': {},
+        'snapshot_hash': snapshot_hash,
+        'snapshots': [{'hash': snapshot_hash, 'fetched': '2019-09-20 00:00:00'}],
         'country_data_expiry': expiry.strftime('%Y-%m-%d %H:%M:%S'),
-        'aggregation_request_results': {"sum:area:region": {}},
+        'aggregation_request_results': {snapshot_hash: {"sum:area:region": {}}},
     }
     handle = mock_cache_file()
     handle.write.assert_called_with(json.dumps(cache_data))
@@ -82,15 +101,91 @@ def test_process_aggregation_request_valid_request_cached_data(mock_args, mock_c
         mock_isfile.return_value = True
         expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
         read_data = {
-            'country_data': {},
+            'snapshot_hash': 'abc',
+            'snapshots': [{'hash': 'abc', 'fetched': '2019-09-20 00:00:00'}],
             'country_data_expiry': expiry.strftime('%Y-%m-%d %H:%M:%S'),
             'aggregation_request_results': {},
         }
         with patch('builtins.open', mock_open(read_data=json.dumps(read_data))) as mock_cache_file:
-            response, error = process_aggregation_request(mock_args)
+            with patch.object(CountryDataAggregator, 'read_snapshot', return_value=[{'area': 1, 'region': 'a'}]) as mock_read_snapshot:
+                with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+                    response, error = process_aggregation_request(mock_args)
 
+    mock_get.assert_not_called()
+    mock_read_snapshot.assert_called_once_with('abc')
     assert error is None
-    assert response == {}
+    assert response == {'a': 1}
+
+@pytest.mark.parametrize(
+    'as_of, expected_response, expected_error',
+    [
+        (datetime.datetime(2019, 9, 20, 12), {'a': 1}, None), # first snapshot
+        (datetime.datetime(2019, 9, 21, 12), {'a': 2}, None), # second snapshot
+        (datetime.datetime(2019, 9, 19), None, 'No country data retained as of 2019-09-19 00:00:00.'), # before any snapshot
+    ],
+)
+def test_process_aggregation_request_as_of(mock_args, as_of, expected_response, expected_error):
+    with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
+        mock_isfile.return_value = True
+        read_data = {
+            'snapshot_hash': 'def',
+            'snapshots': [
+                {'hash': 'abc', 'fetched': '2019-09-20 00:00:00'},
+                {'hash': 'def', 'fetched': '2019-09-21 00:00:00'},
+            ],
+            'country_data_expiry': '2019-09-21 01:00:00',
+            'aggregation_request_results': {
+                'abc': {'sum:area:region': {'a': 1}},
+                'def': {'sum:area:region': {'a': 2}},
+            },
+        }
+        with patch('builtins.open', mock_open(read_data=json.dumps(read_data))):
+            with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+                response, error = process_aggregation_request(mock_args, as_of)
+
+    mock_get.assert_not_called()
+    assert response == expected_response
+    assert error == expected_error
+
+def test_process_aggregation_request_as_of_snapshot_missing(mock_args):
+    with patch('aggregation.country_data_aggregator.os.path.isfile') as mock_isfile:
+        mock_isfile.return_value = True
+        read_data = {
+            'snapshot_hash': 'def',
+            'snapshots': [
+                {'hash': 'abc', 'fetched': '2019-09-20 00:00:00'},
+                {'hash': 'def', 'fetched': '2019-09-21 00:00:00'},
+            ],
+            'country_data_expiry': '2019-09-21 01:00:00',
+            'aggregation_request_results': {},
+        }
+        with patch('builtins.open', mock_open(read_data=json.dumps(read_data))):
+            with patch.object(CountryDataAggregator, 'read_snapshot', side_effect=[[{'area': 2, 'region': 'a'}], None]):
+                response, error = process_aggregation_request(mock_args, datetime.datetime(2019, 9, 20, 12))
+
+    assert response is None
+    assert error == 'No country data retained as of 2019-09-20 12:00:00.'
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        ('2019-09-20 12:30:00', datetime.datetime(2019, 9, 20, 12, 30)), # date and time
+        ('2019-09-20', datetime.datetime(2019, 9, 20, 23, 59, 59)), # date alone is end of day
+    ],
+)
+def test_parse_as_of(value, expected):
+    assert parse_as_of(value) == expected
+
+@pytest.mark.parametrize(
+    'value',
+    [
+        ('yesterday'), # not a date
+        ('2019-09-20T12:30:00'), # unsupported format
+    ],
+)
+def test_parse_as_of_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_as_of(value)
 
 def test_process_aggregation_request_bad_request():
     params = {
@@ -120,3 +215,145 @@ def test_process_aggregation_request_api_exception(mock_args, mock_cache_file):
 
     assert error == 'Could not retrieve country data, please try again later.'
 
+def mock_response(status_code=200, text='[]', headers=None):
+    response = Mock()
+    response.status_code = status_code
+    response.text = text
+    response.headers = headers or {}
+    return response
+
+@pytest.mark.parametrize(
+    'headers, expected',
+    [
+        ({}, 86400), # no cache control
+        ({'Cache-Control': 'a=b'}, 86400), # no max age
+        ({'Cache-Control': 'public, max-age=60'}, 60), # max age
+        ({'Cache-Control': 'max-age=soon'}, 86400), # malformed max age
+    ],
+)
+def test_get_max_age(headers, expected):
+    assert get_max_age(headers) == expected
+
+@pytest.mark.parametrize(
+    'text, expected',
+    [
+        ('[{"area": 1}]', ([{'area': 1}], None, 86400)), # unpaginated list
+        ('{"data": [{"area": 1}], "next": "abc"}', ([{'area': 1}], 'abc', 86400)), # paginated page
+        ('{"data": null}', ([], None, 86400)), # empty last page
+    ],
+)
+def test_fetch_page(text, expected):
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.return_value = mock_response(text=text)
+        assert fetch_page('url') == expected
+
+@pytest.mark.parametrize(
+    'text',
+    [
+        ('{"message": "not found"}'), # dictionary without records
+        ('{"data": {"area": 1}}'), # records not a list
+        ('"text"'), # not a page
+        ('{"data": [], "next": {"page": 2}}'), # cursor not a string or number
+    ],
+)
+def test_fetch_page_unexpected_format(text):
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.return_value = mock_response(text=text)
+        with pytest.raises(FetchError):
+            fetch_page('url')
+
+    assert mock_get.call_count == 1
+
+def test_fetch_page_request_params():
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.return_value = mock_response()
+        fetch_page('url', 'abc')
+
+    params = {'fields': ','.join(get_projected_fields()), 'cursor': 'abc'}
+    mock_get.assert_called_once_with('url', params=params, timeout=15)
+
+@pytest.mark.parametrize(
+    'first_response, second_response, expected_sleeps',
+    [
+        (Exception('timeout'), mock_response(status_code=500), [0.5, 1.0]), # exception and server error
+        (mock_response(status_code=408), mock_response(status_code=429), [0.5, 1.0]), # request timeout and too many requests
+        (mock_response(text='[{"area"'), mock_response(status_code=503), [0.5, 1.0]), # invalid json
+        (mock_response(status_code=429, headers={'Retry-After': '3'}), mock_response(status_code=503, headers={'Retry-After': '2'}), [3.0, 2.0]), # numeric retry after
+        (mock_response(status_code=429, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), mock_response(status_code=429, headers={'Retry-After': '600'}), [0.5, 15]), # http date ignored, capped at timeout
+    ],
+)
+def test_fetch_page_retry(mock_sleep, first_response, second_response, expected_sleeps):
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.side_effect = [
+            first_response,
+            second_response,
+            mock_response(text='[{"area": 1}]'),
+        ]
+        records, cursor, seconds = fetch_page('url')
+
+    assert mock_get.call_count == 3
+    assert records == [{'area': 1}]
+    assert [call[0][0] for call in mock_sleep.call_args_list] == expected_sleeps
+
+@pytest.mark.parametrize(
+    'status_code',
+    [
+        (400), # bad request
+        (403), # forbidden
+        (404), # not found
+    ],
+)
+def test_fetch_page_client_error(status_code):
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.return_value = mock_response(status_code=status_code)
+        with pytest.raises(FetchError):
+            fetch_page('url')
+
+    assert mock_get.call_count == 1
+
+def test_fetch_page_failure():
+    with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+        mock_get.return_value = mock_response(status_code=500)
+        with pytest.raises(FetchError):
+            fetch_page('url')
+
+    assert mock_get.call_count == 3
+
+def test_fetch_country_data():
+    pages = {
+        ('a', None): mock_response(text='{"data": [{"area": 1}], "next": "a2"}'),
+        ('a', 'a2'): mock_response(text='{"data": [{"area": 2}]}', headers={'Cache-Control': 'max-age=60'}),
+        ('b', None): mock_response(text='[{"area": 3}]', headers={'Cache-Control': 'max-age=120'}),
+    }
+
+    def get_page(url, params, timeout):
+        return pages[(url, params.get('cursor'))]
+
+    with patch('aggregation.aggregation_processor.DATA_SOURCES', ['a', 'b']):
+        with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+            mock_get.side_effect = get_page
+            country_data, cache_time = fetch_country_data()
+
+    assert sorted(country_data, key=lambda record: record['area']) == [{'area': 1}, {'area': 2}, {'area': 3}]
+    assert cache_time == 60
+
+@pytest.mark.parametrize(
+    'max_pages, text',
+    [
+        (1000, '{"data": [{"area": 1}], "next": "same"}'), # repeated cursor
+        (3, '{"data": [{"area": 1}], "next": "%s"}'), # page limit
+    ],
+)
+def test_fetch_country_data_runaway_cursor(max_pages, text):
+    cursors = iter(range(1000))
+
+    def get_page(url, params, timeout):
+        return mock_response(text=text.replace('%s', str(next(cursors))))
+
+    with patch('aggregation.aggregation_processor.MAX_PAGES', max_pages):
+        with patch('aggregation.aggregation_processor.requests.get') as mock_get:
+            mock_get.side_effect = get_page
+            with pytest.raises(FetchError):
+                fetch_country_data()
+
+    assert mock_get.call_count <= max_pages
@@ -1,8 +1,12 @@
 import pytest
 
-from aggregation.validation import validate_aggregation_request
+from aggregation.validation import get_projected_fields, validate_aggregation_request
 
 
+def test_get_projected_fields():
+    fields = get_projected_fields()
+    assert fields == ['area', 'borders', 'currencies', 'gini', 'languages', 'latlng', 'population', 'region', 'subregion']
+
 def test_aggregation_request_valid():
     params = {
         'aggregation': 'avg',